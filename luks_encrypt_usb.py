@@ -2,119 +2,470 @@ import subprocess
 import sys
 import os
 import time
-import json
+import re
+import select
+import signal
 import threading
 import getpass
-from datetime import datetime
+import functools
+import ctypes
 
 DEBUG = False  # Set to True for verbose device detection debugging
 
+# Matches one KEY="VALUE" pair of lsblk --pairs output.
+_LSBLK_PAIRS_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# libblkid lets us enumerate removable devices in-process instead of forking
+# lsblk and parsing its JSON. Fall back to the lsblk path if it's unavailable.
+try:
+    _libblkid = ctypes.CDLL("libblkid.so.1", use_errno=True)
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libblkid.blkid_get_cache.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_char_p]
+    _libblkid.blkid_probe_all_removable.argtypes = [ctypes.c_void_p]
+    _libblkid.blkid_put_cache.argtypes = [ctypes.c_void_p]
+    _libblkid.blkid_get_tag_value.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    _libblkid.blkid_get_tag_value.restype = ctypes.c_void_p  # malloc'd string, freed below
+    _libc.free.argtypes = [ctypes.c_void_p]
+except OSError:
+    _libblkid = None
+
+# Optional libcryptsetup bindings: keeps repeated cryptsetup operations
+# in-process instead of paying fork+exec+library init per invocation.
+try:
+    import pycryptsetup
+except ImportError:
+    pycryptsetup = None
+
 # --- Spinner Class for Feedback ---
 class Spinner:
+    # Driven by SIGALRM/setitimer on the main thread: one signal delivery per
+    # tick instead of a dedicated thread sleeping in a Python loop. Callers on
+    # other threads get the old thread-based spinner, since signal handlers can
+    # only be installed from the main thread.
     def __init__(self, message="Processing..."):
         self.spinner_symbols = ['-', '\\', '|', '/']
         self.delay = 0.1
         self.running = False
         self.spinner_thread = None
         self.message = message
+        self._symbol_index = 0
+        self._prev_handler = None
+        # Pre-encoded segments for os.writev: one gathered syscall per tick
+        # instead of separate write+flush calls.
+        self._msg_bytes = message.encode()
+        self._symbol_bytes = [symbol.encode() for symbol in self.spinner_symbols]
+
+    def _write_frame(self, symbol_index):
+        # os.writev is async-signal-safe, unlike buffered sys.stdout.
+        os.writev(1, [b"\r", self._msg_bytes, b" ", self._symbol_bytes[symbol_index]])
+
+    def _tick(self, signum, frame):
+        self._write_frame(self._symbol_index)
+        self._symbol_index = (self._symbol_index + 1) % len(self.spinner_symbols)
+
+    def _clear_line(self):
+        os.writev(1, [b"\r", b" " * (len(self.message) + 5), b"\r"])
 
     def _spin(self):
         while self.running:
-            for symbol in self.spinner_symbols:
+            for i in range(len(self.spinner_symbols)):
                 if not self.running:
                     break
-                sys.stdout.write(f"\r{self.message} {symbol}")
-                sys.stdout.flush()
+                self._write_frame(i)
                 time.sleep(self.delay)
-        sys.stdout.write("\r" + " " * (len(self.message) + 5) + "\r")
-        sys.stdout.flush()
+        self._clear_line()
 
     def start(self):
         self.running = True
-        self.spinner_thread = threading.Thread(target=self._spin)
-        self.spinner_thread.daemon = True
-        self.spinner_thread.start()
+        if threading.current_thread() is threading.main_thread():
+            self._prev_handler = signal.signal(signal.SIGALRM, self._tick)
+            signal.setitimer(signal.ITIMER_REAL, self.delay, self.delay)
+        else:
+            self.spinner_thread = threading.Thread(target=self._spin)
+            self.spinner_thread.daemon = True
+            self.spinner_thread.start()
 
     def stop(self):
         self.running = False
         if self.spinner_thread and self.spinner_thread.is_alive():
             self.spinner_thread.join()
+        elif self._prev_handler is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._prev_handler)
+            self._prev_handler = None
+            self._clear_line()
 
 # --- Utility Functions ---
-def run_command(command, input_data=None, spinner_message=None, check_returncode=True):
-    spinner = None
-    if spinner_message:
-        spinner = Spinner(spinner_message)
-        spinner.start()
-
+class _SpawnFailedError(OSError):
+    # posix_spawn itself failed; the child never started, so it is safe for
+    # run_command to retry the command via subprocess.
+    pass
+
+def _spawn_and_capture(command, input_data):
+    # posix_spawn avoids fork()'s page-table copy (glibc uses vfork-like
+    # CLONE_VM semantics), which dominates startup for short helpers like
+    # lsblk/cryptsetup when the parent has a large RSS.
+    r_in, w_in = os.pipe2(os.O_CLOEXEC)
+    r_out, w_out = os.pipe2(os.O_CLOEXEC)
+    r_err, w_err = os.pipe2(os.O_CLOEXEC)
     try:
-        process = subprocess.run(
-            command,
-            input=input_data,
-            text=True,
-            capture_output=True,
-            check=check_returncode,
-            encoding='utf-8'
+        pid = os.posix_spawnp(
+            command[0], command, os.environ,
+            file_actions=[
+                (os.POSIX_SPAWN_DUP2, r_in, 0),
+                (os.POSIX_SPAWN_DUP2, w_out, 1),
+                (os.POSIX_SPAWN_DUP2, w_err, 2),
+            ]
         )
-        return process.stdout, process.stderr
-    except subprocess.CalledProcessError as e:
-        print(f"\nError executing command: {' '.join(command)}")
-        print(f"STDOUT: {e.stdout}")
-        print(f"STDERR: {e.stderr}")
-        raise
+    except OSError as e:
+        for fd in (r_in, w_in, r_out, w_out, r_err, w_err):
+            os.close(fd)
+        raise _SpawnFailedError(*e.args) from e
+    os.close(r_in)
+    os.close(w_out)
+    os.close(w_err)
+
+    try:
+        if input_data:
+            os.write(w_in, input_data.encode('utf-8'))
+    except BrokenPipeError:
+        pass  # child exited before reading stdin; same as subprocess.communicate
     finally:
-        if spinner:
-            spinner.stop()
+        os.close(w_in)
+
+    chunks = {r_out: [], r_err: []}
+    open_fds = {r_out, r_err}
+    while open_fds:
+        readable, _, _ = select.select(list(open_fds), [], [])
+        for fd in readable:
+            chunk = os.read(fd, 65536)
+            if chunk:
+                chunks[fd].append(chunk)
+            else:
+                os.close(fd)
+                open_fds.discard(fd)
+
+    _, status = os.waitpid(pid, 0)
+    returncode = os.waitstatus_to_exitcode(status)
+    stdout = b''.join(chunks[r_out]).decode('utf-8')
+    stderr = b''.join(chunks[r_err]).decode('utf-8')
+    return returncode, stdout, stderr
+
+def _run_streaming(command, input_data, pass_fds=()):
+    # Forward the child's stderr live instead of buffering it: cryptsetup
+    # reports progress there during long argon2id derivation, and this keeps
+    # memory constant rather than growing a capture buffer.
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        pass_fds=pass_fds
+    )
+
+    def _forward():
+        for line in process.stderr:
+            sys.stderr.write(line)
+            sys.stderr.flush()
+
+    reader = threading.Thread(target=_forward, daemon=True)
+    reader.start()
+    if input_data:
+        process.stdin.write(input_data)
+    process.stdin.close()
+    returncode = process.wait()
+    reader.join()
+    return returncode
+
+def run_command(command, input_data=None, spinner_message=None, check_returncode=True,
+                stream_stderr=False, key_bytes=None):
+    key_fd = None
+    if key_bytes is not None:
+        # Hand the passphrase to cryptsetup as raw bytes over an anonymous
+        # pipe via --key-file=/dev/fd/N: no text-mode re-encode in Python and
+        # the secret stays off the child's stdin stream.
+        key_fd, write_fd = os.pipe()
+        os.set_inheritable(key_fd, True)
+        os.write(write_fd, key_bytes)
+        os.close(write_fd)
+        command = list(command) + [f"--key-file=/dev/fd/{key_fd}"]
+
+    pass_fds = (key_fd,) if key_fd is not None else ()
+    try:
+        if stream_stderr:
+            # Live stderr is the progress feedback; a spinner would garble it.
+            if spinner_message:
+                print(f"{spinner_message}...")
+            returncode = _run_streaming(command, input_data, pass_fds=pass_fds)
+            if check_returncode and returncode != 0:
+                print(f"\nError executing command: {' '.join(command)}")
+                raise subprocess.CalledProcessError(returncode, command)
+            return '', ''
+
+        spinner = None
+        if spinner_message:
+            spinner = Spinner(spinner_message)
+            spinner.start()
 
-def get_block_devices():
+        try:
+            try:
+                returncode, stdout, stderr = _spawn_and_capture(command, input_data)
+            except _SpawnFailedError:
+                # posix_spawn unavailable or failed before the child started;
+                # take the portable path. I/O errors after a successful spawn
+                # propagate instead, so the command never runs twice.
+                process = subprocess.run(
+                    command,
+                    input=input_data,
+                    text=True,
+                    capture_output=True,
+                    check=False,
+                    encoding='utf-8',
+                    pass_fds=pass_fds
+                )
+                returncode, stdout, stderr = process.returncode, process.stdout, process.stderr
+
+            if check_returncode and returncode != 0:
+                raise subprocess.CalledProcessError(returncode, command, output=stdout, stderr=stderr)
+            return stdout, stderr
+        except subprocess.CalledProcessError as e:
+            print(f"\nError executing command: {' '.join(command)}")
+            print(f"STDOUT: {e.stdout}")
+            print(f"STDERR: {e.stderr}")
+            raise
+        finally:
+            if spinner:
+                spinner.stop()
+    finally:
+        if key_fd is not None:
+            os.close(key_fd)
+
+def _read_sysfs(path):
     try:
-        stdout, _ = run_command(
-            ["lsblk", "--json", "-o", "NAME,SIZE,TYPE,ROTA,MODEL,VENDOR,FSTYPE,MOUNTPOINT,RM"],
-            check_returncode=True
-        )
-        data = json.loads(stdout)
-    except Exception as e:
-        print(f"Error listing block devices: {e}")
-        sys.exit(1)
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def _format_size(num_bytes):
+    # Mirrors lsblk's human-readable SIZE column (powers of 1024, one decimal).
+    size = float(num_bytes)
+    for unit in ("B", "K", "M", "G", "T", "P"):
+        if size < 1024 or unit == "P":
+            break
+        size /= 1024.0
+    if unit == "B":
+        return f"{int(size)}B"
+    text = f"{size:.1f}"
+    if text.endswith(".0"):
+        text = text[:-2]
+    return f"{text}{unit}"
+
+def _blkid_tag(cache, tag, device_path):
+    ptr = _libblkid.blkid_get_tag_value(cache, tag.encode(), device_path.encode())
+    if not ptr:
+        return None
+    try:
+        return ctypes.string_at(ptr).decode()
+    finally:
+        _libc.free(ptr)
+
+def _mounted_kernel_names():
+    # Kernel names of every mounted block device. Device-mapper sources
+    # (/dev/mapper/<name>, as created by this script) are resolved down to the
+    # disks/partitions they sit on by walking /sys/class/block/<name>/slaves,
+    # so an open-and-mounted LUKS mapper still marks its disk as mounted.
+    names = set()
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if not fields or not fields[0].startswith("/dev/"):
+                    continue
+                stack = [os.path.basename(os.path.realpath(fields[0]))]
+                while stack:
+                    name = stack.pop()
+                    if name in names:
+                        continue
+                    names.add(name)
+                    try:
+                        stack.extend(os.listdir(f"/sys/class/block/{name}/slaves"))
+                    except OSError:
+                        pass
+    except OSError:
+        pass
+    return names
+
+def _get_block_devices_blkid():
+    cache = ctypes.c_void_p()
+    if _libblkid.blkid_get_cache(ctypes.byref(cache), None) != 0:
+        raise OSError("blkid_get_cache failed")
+    try:
+        _libblkid.blkid_probe_all_removable(cache)
+        mounted = _mounted_kernel_names()
+
+        devices = []
+        for name in sorted(os.listdir("/sys/block")):
+            if "nvme" in name.lower():
+                continue
+            if _read_sysfs(f"/sys/block/{name}/removable") != "1":
+                continue
+
+            device_name = f"/dev/{name}"
+            sectors = _read_sysfs(f"/sys/block/{name}/size")
+            size = _format_size(int(sectors) * 512) if sectors.isdigit() else "Unknown Size"
+            model = _read_sysfs(f"/sys/block/{name}/device/model")
+            vendor = _read_sysfs(f"/sys/block/{name}/device/vendor")
+
+            # Partition entries under /sys/block/<disk> cover both naming
+            # schemes (sda1 as well as mmcblk0p1).
+            partitions = [
+                entry for entry in sorted(os.listdir(f"/sys/block/{name}"))
+                if entry.startswith(name) and os.path.isdir(f"/sys/block/{name}/{entry}")
+            ]
+            is_mounted = name in mounted or any(part in mounted for part in partitions)
+
+            child_fstypes = []
+            for entry in partitions:
+                child_fstype = _blkid_tag(cache, "TYPE", f"/dev/{entry}")
+                if child_fstype:
+                    child_fstypes.append(child_fstype)
+
+            display_name = f"{vendor} {model} {size}" if model and vendor else f"{device_name} {size}"
+            devices.append({
+                'name': device_name,
+                'size': size,
+                'display_name': display_name,
+                'model': model,
+                'vendor': vendor,
+                'is_mounted': is_mounted,
+                'fstype': _blkid_tag(cache, "TYPE", device_name),
+                'pttype': _blkid_tag(cache, "PTTYPE", device_name),
+                'child_fstypes': child_fstypes
+            })
+        return devices
+    finally:
+        _libblkid.blkid_put_cache(cache)
+
+def _parse_lsblk_pairs(stdout):
+    # One regex pass over KEY="VALUE" lines beats running the full JSON
+    # tokenizer for the handful of fields we actually extract.
+    return [
+        {key.lower(): value for key, value in _LSBLK_PAIRS_RE.findall(line)}
+        for line in stdout.splitlines() if line.strip()
+    ]
+
+def _get_block_devices_lsblk():
+    # One batched probe: FSTYPE and PTTYPE ride along so LUKS detection and
+    # partition-table checks become dict lookups instead of extra subprocesses.
+    # --pairs output is flat, so PKNAME is requested to group rows back under
+    # their parent disk.
+    stdout, _ = run_command(
+        ["lsblk", "--pairs", "-o",
+         "NAME,PKNAME,SIZE,TYPE,ROTA,MODEL,VENDOR,FSTYPE,PTTYPE,MOUNTPOINT,RM"],
+        check_returncode=True
+    )
+    blocks = _parse_lsblk_pairs(stdout)
 
     devices = []
-    for block in data.get('blockdevices', []):
+    by_name = {}
+    for block in blocks:
         if block.get('type') != 'disk':
             continue
         device_name = f"/dev/{block['name']}"
-        size = block.get('size', 'Unknown Size')
+        size = block.get('size') or 'Unknown Size'
         model = (block.get('model') or '').strip()
         vendor = (block.get('vendor') or '').strip()
-        removable = block.get('rm', False)
+        removable = block.get('rm') == '1'
 
         if "nvme" in block['name'].lower():
             continue
         if not removable:
             continue
 
-        is_mounted = False
-        if block.get('mountpoint'):
-            is_mounted = True
-        if 'children' in block:
-            for child in block['children']:
-                if child.get('mountpoint'):
-                    is_mounted = True
-                    break
         # We don't filter out mounted devices here, as the user might want to open an already LUKS-encrypted,
         # but currently mounted, device after unmounting.
-
         display_name = f"{vendor} {model} {size}" if model and vendor else f"{device_name} {size}"
-        devices.append({
+        device = {
             'name': device_name,
             'size': size,
             'display_name': display_name,
             'model': model,
             'vendor': vendor,
-            'is_mounted': is_mounted # Add mount status to device info
-        })
+            'is_mounted': bool(block.get('mountpoint')), # Add mount status to device info
+            'fstype': block.get('fstype') or None,
+            'pttype': block.get('pttype') or None,
+            'child_fstypes': []
+        }
+        devices.append(device)
+        by_name[block['name']] = device
+
+    # Second pass: fold child rows into their parent disk. PKNAME links are
+    # walked upwards because crypt mappers sit on a partition, which in turn
+    # sits on the disk.
+    pkname_of = {block['name']: block.get('pkname') for block in blocks if block.get('name')}
+    for block in blocks:
+        if block.get('type') == 'disk':
+            continue
+        parent = None
+        name = block.get('pkname')
+        seen = set()
+        while name and name not in seen:
+            seen.add(name)
+            if name in by_name:
+                parent = by_name[name]
+                break
+            name = pkname_of.get(name)
+        if parent is None:
+            continue
+        if block.get('mountpoint'):
+            parent['is_mounted'] = True
+        if block.get('fstype'):
+            parent['child_fstypes'].append(block['fstype'])
+    return devices
+
+# Probe results keyed by device path, so later lookups for a device that
+# get_block_devices already scanned are O(1) instead of another subprocess.
+# Mirrors libblkid's own cache semantics: scan each device at most once.
+_DEVICE_INFO_CACHE = {}
+
+def refresh_devices():
+    # Drop cached probe results, e.g. after re-encrypting changed a device.
+    _DEVICE_INFO_CACHE.clear()
+
+def get_block_devices():
+    devices = None
+    try:
+        if _libblkid is not None:
+            devices = _get_block_devices_blkid()
+    except Exception as e:
+        if DEBUG:
+            print(f"DEBUG: libblkid enumeration failed, falling back to lsblk: {e}")
+    if devices is None:
+        try:
+            devices = _get_block_devices_lsblk()
+        except Exception as e:
+            print(f"Error listing block devices: {e}")
+            sys.exit(1)
+    for i, device in enumerate(devices):
+        _DEVICE_INFO_CACHE[device['name']] = device
+        mount_status = "(Currently Mounted)" if device['is_mounted'] else ""
+        device['menu_line'] = f"  [{i + 1}] {device['name']} ({device['display_name']}) {mount_status}"
     return devices
 
-def get_partition_table_type(device_path):
+def _probe_partition_table(device_path):
+    # lsblk answers PTTYPE from the udev/blkid probe already done at plug time,
+    # without opening the device; parted (which re-reads the disk) is only the
+    # last resort when that comes back empty.
+    try:
+        stdout, _ = run_command(["lsblk", "-ndo", "PTTYPE", device_path], check_returncode=False)
+        pttype = stdout.strip().splitlines()[0].strip() if stdout.strip() else ""
+        if pttype:
+            return pttype.lower()
+    except Exception:
+        pass
     try:
         stdout, _ = run_command(["parted", "-s", device_path, "print"], check_returncode=False)
         for line in stdout.splitlines():
@@ -124,28 +475,89 @@ def get_partition_table_type(device_path):
         pass
     return "unknown"
 
-def detect_luks_encryption(device_path):
+@functools.lru_cache(maxsize=32)
+def _pt_type_cached(device_path, uevent_mtime_ns):
+    # uevent_mtime_ns is part of the key: a device event (repartition,
+    # replug) bumps the mtime, which misses the cache and re-probes.
+    return _probe_partition_table(device_path)
+
+def get_partition_table_type(device):
+    # get_block_devices already probed PTTYPE; only fall back to parted for
+    # bare paths (or when the probe came back empty), caching that probe too
+    # since parted makes the kernel re-read the disk.
+    if isinstance(device, str):
+        device = _DEVICE_INFO_CACHE.get(device, device)
+    if isinstance(device, dict):
+        if device.get('pttype'):
+            return device['pttype'].lower()
+        device_path = device['name']
+    else:
+        device_path = device
     try:
-        stdout, _ = run_command(["lsblk", "--json", "-o", "NAME,TYPE,FSTYPE", device_path], check_returncode=True)
-        data = json.loads(stdout)
-        
-        def is_crypt_type(entry):
-            return entry.get("type") == "crypt" or entry.get("fstype") == "crypto_LUKS"
-
-        if is_crypt_type(data['blockdevices'][0]):
-            return True
-        
-        for child in data['blockdevices'][0].get("children", []):
-            if is_crypt_type(child):
+        mtime = os.stat(f"/sys/block/{os.path.basename(device_path)}/uevent").st_mtime_ns
+    except OSError:
+        return _probe_partition_table(device_path)
+    return _pt_type_cached(device_path, mtime)
+
+def detect_luks_encryption(device):
+    # Pure dict lookup when given a device from get_block_devices; the lsblk
+    # probe below only runs for paths that miss the cache.
+    if isinstance(device, str):
+        device = _DEVICE_INFO_CACHE.get(device, device)
+    if isinstance(device, dict):
+        return (device.get('fstype') == 'crypto_LUKS'
+                or any(fstype == 'crypto_LUKS' for fstype in device.get('child_fstypes', [])))
+    device_path = device
+    try:
+        stdout, _ = run_command(
+            ["lsblk", "--pairs", "-o", "NAME,TYPE,FSTYPE", device_path],
+            check_returncode=True
+        )
+        # Pairs output includes the device and all descendants as flat rows.
+        for entry in _parse_lsblk_pairs(stdout):
+            if entry.get("type") == "crypt" or entry.get("fstype") == "crypto_LUKS":
                 return True
     except Exception as e:
         if DEBUG:
             print(f"DEBUG: Could not determine LUKS status for {device_path}: {e}")
     return False
 
+def luks_open(device_path, mapper_name, passphrase, spinner_message=None):
+    # Activate in-process via libcryptsetup when the bindings are available:
+    # no fork and no libcryptsetup re-init for each invocation. Only a
+    # confirmed success counts - common pycryptsetup builds are LUKS1-era and
+    # fail on the LUKS2 headers this script formats - so anything else falls
+    # through to the CLI, which produces the exit codes and stderr
+    # diagnostics the callers rely on.
+    if spinner_message:
+        print(f"{spinner_message}...")
+    if pycryptsetup is not None:
+        try:
+            crypt = pycryptsetup.CryptSetup(device=device_path)
+            if crypt.luksOpen(name=mapper_name, passphrase=passphrase) == 0:
+                return
+        except Exception:
+            pass
+    run_command(
+        ["cryptsetup", "luksOpen", device_path, mapper_name],
+        key_bytes=passphrase.encode(),
+        stream_stderr=True
+    )
+
+def mapper_exists(mapper_name):
+    # /dev/mapper entries are symlinks to /dev/dm-N; lstat skips the symlink
+    # resolution os.path.exists would do and distinguishes a true ENOENT.
+    try:
+        os.lstat(f"/dev/mapper/{mapper_name}")
+        return True
+    except FileNotFoundError:
+        return False
+
 def luks_header_backup(device_path):
     device_base = os.path.basename(device_path)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # UTC via time.strftime: no datetime object allocation, and the name stays
+    # monotonic across DST changes.
+    timestamp = time.strftime("%Y%m%d_%H%M%S", time.gmtime())
     backup_dir = os.path.expanduser("~/luks_backups")
     os.makedirs(backup_dir, exist_ok=True)
     backup_file = os.path.join(backup_dir, f"{device_base}_{timestamp}.header")
@@ -156,8 +568,26 @@ def luks_header_backup(device_path):
     except Exception as e:
         print(f"Failed to back up LUKS header: {e}")
 
+_CAP_SYS_ADMIN = 1 << 21
+_privileged = None  # cached result of the privilege check
+
+def _has_cap_sys_admin():
+    # One read of /proc/self/status instead of shelling out to capsh; cryptsetup
+    # needs CAP_SYS_ADMIN, which can be granted without a root euid.
+    try:
+        with open("/proc/self/status", "rb") as f:
+            for line in f:
+                if line.startswith(b"CapEff:"):
+                    return bool(int(line.split()[1], 16) & _CAP_SYS_ADMIN)
+    except (OSError, ValueError, IndexError):
+        pass
+    return False
+
 def check_root_privileges():
-    if os.geteuid() != 0:
+    global _privileged
+    if _privileged is None:
+        _privileged = os.geteuid() == 0 or _has_cap_sys_admin()
+    if not _privileged:
         print("This script must be run with root privileges. Try:\n  sudo python3 script.py")
         sys.exit(1)
 
@@ -175,10 +605,9 @@ def main():
         print("No suitable USB devices found. Ensure it's connected, unmounted, and removable.")
         sys.exit(0)
 
-    print("\nAvailable USB Devices:")
-    for i, device in enumerate(suitable_devices):
-        mount_status = "(Currently Mounted)" if device['is_mounted'] else ""
-        print(f"  [{i + 1}] {device['name']} ({device['display_name']}) {mount_status}")
+    # Single joined write: one syscall for the whole menu instead of one per line.
+    sys.stdout.write("\nAvailable USB Devices:\n"
+                     + "\n".join(device['menu_line'] for device in suitable_devices) + "\n")
 
     while True:
         selection = input("\nEnter the number of the device to encrypt/open (or 'q' to quit): ").strip()
@@ -198,7 +627,7 @@ def main():
     device_path = selected_device['name']
     print(f"\nSelected: {device_path} ({selected_device['display_name']})")
 
-    if detect_luks_encryption(device_path):
+    if detect_luks_encryption(selected_device):
         print(f"\nNote: {device_path} appears to be already LUKS-encrypted.")
         while True:
             action = input("Do you want to open it (type 'open'), re-encrypt (type 're-encrypt'), or exit (type 'exit')? ").strip().lower()
@@ -210,16 +639,13 @@ def main():
                 if not mapper_name:
                     print("Mapper name cannot be empty.")
                     sys.exit(1)
-                if os.path.exists(f"/dev/mapper/{mapper_name}"):
+                if mapper_exists(mapper_name):
                     print(f"Error: /dev/mapper/{mapper_name} already exists. Use a different name or close it first.")
                     sys.exit(1)
                 passphrase = getpass.getpass("Enter LUKS passphrase: ")
                 try:
-                    run_command(
-                        ["cryptsetup", "luksOpen", device_path, mapper_name],
-                        input_data=passphrase + "\n",
-                        spinner_message=f"Opening LUKS volume '{mapper_name}'"
-                    )
+                    luks_open(device_path, mapper_name, passphrase,
+                              spinner_message=f"Opening LUKS volume '{mapper_name}'")
                     opened_device_path = f"/dev/mapper/{mapper_name}"
                     print(f"Successfully opened: {opened_device_path}")
                     print("You may now mount it (e.g., 'sudo mount /dev/mapper/{mapper_name} /mnt/usb')")
@@ -246,7 +672,7 @@ def main():
                 print("Invalid choice. Type 'open', 're-encrypt', or 'exit'.")
     
     # If not detected as LUKS or user chose to re-encrypt, proceed with encryption
-    pt_type = get_partition_table_type(device_path)
+    pt_type = get_partition_table_type(selected_device)
     if pt_type != 'gpt':
         print(f"\nError: {device_path} uses '{pt_type}' partition table.")
         print("Only GPT is supported. Convert it using tools like 'gparted' or 'parted'.")
@@ -280,10 +706,13 @@ def main():
              "--iter-time", "2000",
              "--pbkdf", "argon2id",
              device_path],
-            input_data="YES\n" + passphrase1 + "\n" + passphrase1 + "\n", # Add "YES" for confirmation
-            spinner_message=f"Formatting {device_path} with LUKS"
+            input_data="YES\n", # "YES" confirmation still rides stdin; the key goes via --key-file
+            key_bytes=passphrase1.encode(),
+            spinner_message=f"Formatting {device_path} with LUKS",
+            stream_stderr=True
         )
         print(f"\nSuccessfully formatted {device_path} with LUKS.")
+        refresh_devices()  # cached probe results are stale after formatting
     except Exception as e:
         print(f"Formatting failed: {e}")
         sys.exit(1)
@@ -295,16 +724,13 @@ def main():
         print("Mapper name cannot be empty.")
         sys.exit(1)
 
-    if os.path.exists(f"/dev/mapper/{mapper_name}"):
+    if mapper_exists(mapper_name):
         print(f"/dev/mapper/{mapper_name} already exists. Please use a different name or close it first.")
         sys.exit(1)
 
     try:
-        run_command(
-            ["cryptsetup", "luksOpen", device_path, mapper_name],
-            input_data=passphrase1 + "\n",
-            spinner_message=f"Opening LUKS volume '{mapper_name}'"
-        )
+        luks_open(device_path, mapper_name, passphrase1,
+                  spinner_message=f"Opening LUKS volume '{mapper_name}'")
         opened_device_path = f"/dev/mapper/{mapper_name}"
         print(f"\nSuccessfully opened: {opened_device_path}")
         print(f"You can now create a filesystem on it, e.g.:\n  sudo mkfs.ext4 {opened_device_path}")